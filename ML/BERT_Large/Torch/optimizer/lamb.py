@@ -1,9 +1,26 @@
 """Lamb optimizer."""
 
-from turtle import distance
+import math
+
 import torch
 import torch.distributed as dist
 from torch.optim import Optimizer
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+try:
+    # apex provides a fused multi-tensor Lamb kernel, use it when it is installed
+    import amp_C
+    from apex.multi_tensor_apply import multi_tensor_applier
+except ImportError:
+    amp_C = None
+
+def _stochastic_round_(dst, src):
+    """Copies the fp32 tensor src into the bf16 tensor dst with stochastic rounding."""
+    # bf16 is the upper half of fp32, adding random low bits before truncating rounds
+    # up with a probability equal to the fraction that is cut off
+    bits = src.view(torch.int32) + torch.randint_like(src, 0, 1 << 16, dtype=torch.int32)
+    bits.bitwise_and_(-65536)
+    dst.copy_(bits.view(torch.float32))
 
 class Lamb(Optimizer):
     r"""Implements Lamb algorithm.
@@ -21,6 +38,22 @@ class Lamb(Optimizer):
         weight_decay (float, optional): weight decay (L2 penalty) (default: 0)
         adam (bool, optional): always use trust ratio = 1, which turns this into
             Adam. Useful for comparison purposes.
+        fused (bool, optional): use apex's fused multi-tensor Lamb CUDA kernel
+            for groups of fp32 CUDA parameters when apex is installed
+            (default: True)
+        perform_allreduce (bool, optional): average the gradients across ranks
+            before the update, for use without DistributedDataParallel. The
+            gradients are reduced in buckets launched from the backward pass
+            (default: False)
+        bucket_cap_mb (int, optional): size of the gradient allreduce buckets
+            used with perform_allreduce (default: 25)
+        overlap (bool, optional): update each parameter from a grad hook as soon
+            as its gradient is ready, once register_overlap has been called.
+            step then only finishes the outstanding updates (default: False)
+        states_dtype (torch.dtype, optional): dtype of the moment estimates,
+            torch.float32 or torch.bfloat16. With bf16 the update is still computed
+            in fp32 and stochastically rounded back into the moments, and bf16
+            params do not keep an fp32 master copy (default: torch.float32)
 
     .. _Large Batch Optimization for Deep Learning: Training BERT in 76 minutes:
         https://arxiv.org/abs/1904.00962
@@ -36,6 +69,10 @@ class Lamb(Optimizer):
         adam=False,
         bias_correction=True,
         perform_allreduce=False,
+        fused=True,
+        bucket_cap_mb=25,
+        overlap=False,
+        states_dtype=torch.float32,
     ):
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -45,31 +82,386 @@ class Lamb(Optimizer):
             raise ValueError("Invalid beta parameter at index 0: {}".format(betas[0]))
         if not 0.0 <= betas[1] < 1.0:
             raise ValueError("Invalid beta parameter at index 1: {}".format(betas[1]))
+        if states_dtype not in (torch.float32, torch.bfloat16):
+            raise ValueError("Invalid optimizer states dtype: {}".format(states_dtype))
         defaults = dict(lr=lr, betas=betas, eps=eps, weight_decay=weight_decay)
         self.adam = adam
         self.bias_correction = bias_correction
         self.perform_allreduce = perform_allreduce
+        self.fused = fused and amp_C is not None
+        self.overlap = overlap
+        self.states_dtype = states_dtype
         self.distributed = (
             dist.is_initialized()
             and dist.get_world_size() > 1
         )
         super(Lamb, self).__init__(params, defaults)
+        self._buckets = []
+        self._overlap_registered = False
+        self._flat_states = None
+        if self.perform_allreduce and self.distributed:
+            self._init_grad_buckets(bucket_cap_mb)
+
+    def register_overlap(self, model):
+        """Runs the update of every parameter during backward, as soon as its
+        (allreduced) gradient is ready, instead of after backward in step.
+
+        Gradient accumulation and gradient clipping are not supported in this
+        mode as the update is applied on the first backward.
+        """
+        if not self.overlap or self._overlap_registered:
+            return
+        if isinstance(model, torch.nn.parallel.DistributedDataParallel):
+            raise ValueError("Lamb overlap can not be used with DistributedDataParallel, use perform_allreduce instead")
+        self._overlap_registered = True
+        self._param_group = {}
+        for group in self.param_groups:
+            for p in group["params"]:
+                self._param_group[p] = group
+                # with buckets the update is run by _grad_ready once the bucket is reduced
+                if p.requires_grad and not self._buckets:
+                    p.register_post_accumulate_grad_hook(self._step_hook)
+        self._pending_buckets = []
+
+    def _step_hook(self, p):
+        self._step_one(p, self._param_group[p])
+        p.grad = None
+
+    def _init_grad_buckets(self, bucket_cap_mb):
+        # grads become ready roughly in reverse order of the parameters, bucket them in that
+        # order so each allreduce is launched while backward is still running on earlier layers
+        params = [p for group in self.param_groups for p in group["params"] if p.requires_grad]
+        bucket_cap = bucket_cap_mb * 1024 * 1024
+        bucket, bucket_size = [], 0
+        for p in reversed(params):
+            if bucket and (bucket_size >= bucket_cap or p.dtype != bucket[0].dtype or p.device != bucket[0].device):
+                self._buckets.append(bucket)
+                bucket, bucket_size = [], 0
+            bucket.append(p)
+            bucket_size += p.numel() * p.element_size()
+        if bucket:
+            self._buckets.append(bucket)
+
+        self._param_bucket = {}
+        for idx, bucket in enumerate(self._buckets):
+            for p in bucket:
+                self._param_bucket[p] = idx
+                p.register_post_accumulate_grad_hook(self._grad_ready)
+        self._bucket_ready = [0] * len(self._buckets)
+        self._bucket_work = [None] * len(self._buckets)
+
+    def _grad_ready(self, p):
+        idx = self._param_bucket[p]
+        self._bucket_ready[idx] += 1
+        if self._bucket_ready[idx] == len(self._buckets[idx]):
+            self._launch_allreduce(idx)
+            if self._overlap_registered:
+                # update the previous bucket while this one is being reduced
+                while len(self._pending_buckets) > 1:
+                    self._step_bucket(self._pending_buckets.pop(0))
+
+    def _launch_allreduce(self, idx):
+        self._bucket_ready[idx] = 0
+        grads = [p.grad.data for p in self._buckets[idx] if p.grad is not None]
+        if not grads:
+            return
+        flat = _flatten_dense_tensors(grads)
+        flat.div_(dist.get_world_size())
+        work = dist.all_reduce(flat, async_op=True)
+        self._bucket_work[idx] = (work, flat, grads)
+        if self._overlap_registered:
+            self._pending_buckets.append(idx)
+
+    def _finish_allreduce(self, idx):
+        work, flat, grads = self._bucket_work[idx]
+        work.wait()
+        for grad, synced in zip(grads, _unflatten_dense_tensors(flat, grads)):
+            grad.copy_(synced)
+        self._bucket_work[idx] = None
+
+    def _step_bucket(self, idx):
+        self._finish_allreduce(idx)
+        for p in self._buckets[idx]:
+            self._step_one(p, self._param_group[p])
+            p.grad = None
 
     def sync_params(self):
         if not self.distributed:
             return
+        # one flat broadcast per dtype/device instead of one per tensor
+        params = {}
         for group in self.param_groups:
             for p in group["params"]:
-                distance.broadcase(p.data, 0)
+                params.setdefault((p.device, p.dtype), []).append(p.data)
+        for tensors in params.values():
+            flat = _flatten_dense_tensors(tensors)
+            dist.broadcast(flat, 0)
+            for data, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+                data.copy_(synced)
 
     def sync_grads(self):
         if not self.distributed:
             return
+        if self._buckets:
+            self._wait_grad_buckets()
+            return
         world_size = dist.get_world_size()
+        # one flat allreduce per dtype/device instead of one per tensor
+        grads = {}
         for group in self.param_groups:
             for p in group["params"]:
-                p.grad.data.div_(world_size)
-                dist.all_reduce(p.grad.data)
+                if p.grad is not None:
+                    grads.setdefault((p.grad.device, p.grad.dtype), []).append(p.grad.data)
+        for tensors in grads.values():
+            flat = _flatten_dense_tensors(tensors)
+            flat.div_(world_size)
+            dist.all_reduce(flat)
+            for grad, synced in zip(tensors, _unflatten_dense_tensors(flat, tensors)):
+                grad.copy_(synced)
+
+    def _wait_grad_buckets(self):
+        for idx in range(len(self._buckets)):
+            if self._bucket_work[idx] is None:
+                # not every grad in the bucket was produced by backward, reduce what there is
+                self._launch_allreduce(idx)
+        for idx in range(len(self._buckets)):
+            if self._bucket_work[idx] is not None:
+                self._finish_allreduce(idx)
+
+    def _can_use_fused(self, params):
+        if not self.fused or self.adam or self.states_dtype != torch.float32:
+            return False
+        if len(set(self.state[p]["step"] for p in params)) != 1:
+            return False
+        return all(p.is_cuda and p.dtype == torch.float32 and p.grad.dtype == torch.float32 for p in params)
+
+    def _fused_step(self, group, params, grads, exp_avgs, exp_avg_sqs):
+        # single kernel that updates m/v, computes the per tensor trust ratio and writes back p
+        beta1, beta2 = group["betas"]
+        device = params[0].device
+        multi_tensor_applier(
+            amp_C.multi_tensor_lamb,
+            torch.zeros(1, dtype=torch.int, device=device),
+            [grads, [p.data for p in params], exp_avgs, exp_avg_sqs],
+            group["lr"],
+            beta1,
+            beta2,
+            group["eps"],
+            self.state[params[0]]["step"],
+            int(self.bias_correction),
+            group["weight_decay"],
+            1,  # grad averaging
+            1,  # decoupled weight decay, as in the unfused path
+            torch.zeros(1, dtype=torch.float32, device=device),  # global grad norm, no clipping
+            1.0,  # max grad norm
+            False,  # only apply the trust ratio when weight decay is used
+        )
+
+    def load_state_dict(self, state_dict):
+        super(Lamb, self).load_state_dict(state_dict)
+        # the loaded states are separate tensors, gather them back into the flat buffers
+        self._init_flat_states()
+
+    def _init_flat_states(self):
+        # the moments (and fp32 master weights) of each group live in flat buffers and every
+        # param's state is a view into them, so the group's state is one contiguous block
+        self._flat_states = {}
+        for idx, group in enumerate(self.param_groups):
+            params = [p for p in group["params"] if p.requires_grad]
+            if not params or len(set(p.device for p in params)) != 1:
+                continue
+            flat = {"params": params, "numels": [p.numel() for p in params]}
+            total = sum(flat["numels"])
+            flat["repeats"] = torch.tensor(flat["numels"], device=params[0].device)
+            for key in ("exp_avg", "exp_avg_sq"):
+                flat[key] = torch.zeros(total, dtype=self.states_dtype, device=params[0].device)
+                for p, view in zip(params, flat[key].split(flat["numels"])):
+                    view = view.view_as(p)
+                    if key in self.state[p]:
+                        view.copy_(self.state[p][key])
+                    self.state[p][key] = view
+            masters = [p for p in params if p.dtype == torch.bfloat16 and self.states_dtype == torch.float32]
+            if masters:
+                flat["data_fp32"] = _flatten_dense_tensors(
+                    [self.state[p].get("data_fp32", p.data.to(torch.float32)) for p in masters]
+                )
+                for p, view in zip(masters, _unflatten_dense_tensors(flat["data_fp32"], [p.data for p in masters])):
+                    self.state[p]["data_fp32"] = view
+            for p in params:
+                self.state[p].setdefault("step", 0)
+            self._flat_states[idx] = flat
+
+    def _init_state(self, p):
+        state = self.state[p]
+        if len(state) == 0 and self._flat_states is None:
+            self._init_flat_states()
+        # State initialization, for params that are not covered by the flat buffers
+        if len(state) == 0:
+            state["step"] = 0
+            # Exponential moving average of gradient values
+            state["exp_avg"] = torch.zeros_like(p.data, dtype=self.states_dtype)
+            # Exponential moving average of squared gradient values
+            state["exp_avg_sq"] = torch.zeros_like(p.data, dtype=self.states_dtype)
+            if p.data.dtype == torch.bfloat16 and self.states_dtype == torch.float32:
+                # additional fp32 version of master weights
+                state["data_fp32"] = p.data.to(torch.float32)
+        return state
+
+    def _working_data(self, p, state):
+        if p.data.dtype == torch.bfloat16:
+            return state["data_fp32"] if "data_fp32" in state else p.data.to(torch.float32)
+        return p.data
+
+    def _working_tensors(self, p, state):
+        # the update is always computed in fp32, bf16 state is upcast for the step
+        grad = p.grad.data
+        exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
+        if exp_avg.dtype != torch.float32:
+            exp_avg, exp_avg_sq = exp_avg.to(torch.float32), exp_avg_sq.to(torch.float32)
+        if p.data.dtype == torch.bfloat16:
+            grad = grad.to(torch.float32)
+        return grad, exp_avg, exp_avg_sq, self._working_data(p, state)
+
+    def _store(self, p, state, exp_avg, exp_avg_sq, data):
+        # writes the fp32 working tensors back into the bf16 state and params
+        if exp_avg is not state["exp_avg"]:
+            _stochastic_round_(state["exp_avg"], exp_avg)
+            _stochastic_round_(state["exp_avg_sq"], exp_avg_sq)
+        if p.data.dtype == torch.bfloat16:
+            if "data_fp32" in state:
+                p.data.copy_(data)
+            else:
+                _stochastic_round_(p.data, data)
+
+    @staticmethod
+    def _bias_corrections(beta1, beta2, step):
+        return 1 - beta1 ** step, math.sqrt(1 - beta2 ** step)
+
+    def _trust_ratios(self, params, data_list, adam_steps):
+        weight_norms = torch.stack(torch._foreach_norm(data_list))
+        adam_norms = torch.stack(torch._foreach_norm(adam_steps))
+        if self.adam:
+            trust_ratios = torch.ones_like(weight_norms)
+        else:
+            # the ratios stay on device, .item() or branching on the norms would sync per parameter
+            trust_ratios = torch.where((weight_norms > 0) & (adam_norms > 0), weight_norms / adam_norms, torch.ones_like(weight_norms))
+        for p, weight_norm, adam_norm, trust_ratio in zip(params, weight_norms, adam_norms, trust_ratios):
+            state = self.state[p]
+            state["weight_norm"] = weight_norm
+            state["adam_norm"] = adam_norm
+            state["trust_ratio"] = trust_ratio
+        return trust_ratios
+
+    def _can_use_flat(self, flat):
+        for p in flat["params"]:
+            if p.grad is None or p.grad.is_sparse:
+                return False
+        if len(set(self.state[p]["step"] for p in flat["params"])) != 1:
+            return False
+        return not self._can_use_fused(flat["params"])
+
+    def _flat_step(self, group, flat):
+        """Lamb update of a whole group as elementwise ops on its flat moment buffers."""
+        params = flat["params"]
+        for p in params:
+            self.state[p]["step"] += 1
+        beta1, beta2 = group["betas"]
+
+        grad = _flatten_dense_tensors([p.grad.data.to(torch.float32) for p in params])
+        exp_avg, exp_avg_sq = flat["exp_avg"], flat["exp_avg_sq"]
+        if exp_avg.dtype != torch.float32:
+            exp_avg, exp_avg_sq = exp_avg.to(torch.float32), exp_avg_sq.to(torch.float32)
+
+        # m_t
+        exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+        # v_t
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+        denom = exp_avg_sq.sqrt()
+        if self.bias_correction:
+            bias_correction1, bias_correction2_sqrt = self._bias_corrections(beta1, beta2, self.state[params[0]]["step"])
+            adam_step = exp_avg / denom.add_(group["eps"] * bias_correction2_sqrt)
+            bias_scale = bias_correction2_sqrt / bias_correction1
+        else:
+            adam_step = exp_avg / denom.add_(group["eps"])
+            bias_scale = 1
+        if exp_avg is not flat["exp_avg"]:
+            _stochastic_round_(flat["exp_avg"], exp_avg)
+            _stochastic_round_(flat["exp_avg_sq"], exp_avg_sq)
+
+        # the norms and the weight update need per tensor views of the flat step
+        data_list = [self._working_data(p, self.state[p]) for p in params]
+        adam_steps = [step.view_as(p) for step, p in zip(adam_step.split(flat["numels"]), params)]
+        step_size = group["lr"]
+        if group["weight_decay"] == 0:
+            step_size *= bias_scale
+        else:
+            if bias_scale != 1:
+                adam_step.mul_(bias_scale)
+            torch._foreach_add_(adam_steps, data_list, alpha=group["weight_decay"])
+            trust_ratios = self._trust_ratios(params, data_list, adam_steps)
+            if not self.adam:
+                adam_step.mul_(torch.repeat_interleave(trust_ratios, flat["repeats"], output_size=adam_step.numel()))
+
+        torch._foreach_add_(data_list, adam_steps, alpha=-step_size)
+        for p, data in zip(params, data_list):
+            state = self.state[p]
+            self._store(p, state, state["exp_avg"], state["exp_avg_sq"], data)
+
+    def _step_one(self, p, group):
+        """Lamb update of a single parameter, used when overlapping with backward."""
+        if p.grad is None:
+            return
+        if p.grad.is_sparse:
+            raise RuntimeError(
+                "Lamb does not support sparse gradients, consider SparseAdam instad."
+            )
+        state = self._init_state(p)
+        state["step"] += 1
+
+        grad, exp_avg, exp_avg_sq, data = self._working_tensors(p, state)
+        beta1, beta2 = group["betas"]
+
+        # Decay the first and second moment running average coefficient
+        # m_t
+        exp_avg.mul_(beta1).add_(grad, alpha=(1 - beta1))
+        # v_t
+        exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+
+        denom = exp_avg_sq.sqrt()
+        if self.bias_correction:
+            # Paper v3 does not use debiasing.
+            # Apply bias to lr to avoid broadcast.
+            bias_correction1, bias_correction2_sqrt = self._bias_corrections(beta1, beta2, state["step"])
+            adam_step = exp_avg / denom.add_(group["eps"] * bias_correction2_sqrt)
+            bias_scale = bias_correction2_sqrt / bias_correction1
+        else:
+            adam_step = exp_avg / denom.add_(group["eps"])
+            bias_scale = 1
+
+        step_size = group["lr"]
+        trust_ratio = 1
+        if group["weight_decay"] == 0:
+            step_size *= bias_scale
+        else:
+            # the decay term and the trust ratio need the bias corrected step
+            if bias_scale != 1:
+                adam_step.mul_(bias_scale)
+            adam_step.add_(data, alpha=group["weight_decay"])
+
+            # vector_norm reduces in one kernel without materialising the squares
+            weight_norm = torch.linalg.vector_norm(data)  # .clamp(0, 10)
+            adam_norm = torch.linalg.vector_norm(adam_step)
+            if not self.adam:
+                # kept on device, branching on the norms in python would sync every step
+                trust_ratio = torch.where((weight_norm > 0) & (adam_norm > 0), weight_norm / adam_norm, torch.ones_like(weight_norm))
+                adam_step.mul_(trust_ratio)
+            state["weight_norm"] = weight_norm
+            state["adam_norm"] = adam_norm
+            state["trust_ratio"] = trust_ratio
+
+        data.add_(adam_step, alpha=-step_size)
+        self._store(p, state, exp_avg, exp_avg_sq, data)
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -82,76 +474,96 @@ class Lamb(Optimizer):
         if closure is not None:
             loss = closure()
 
+        if self._overlap_registered:
+            # the updates already ran during backward, only the last buckets are left
+            if self._buckets:
+                for idx in range(len(self._buckets)):
+                    if self._bucket_work[idx] is None and self._bucket_ready[idx] > 0:
+                        self._launch_allreduce(idx)
+                while self._pending_buckets:
+                    self._step_bucket(self._pending_buckets.pop(0))
+            return loss
+
         if self.perform_allreduce:
             self.sync_grads()
 
-        for group in self.param_groups:
+        if self._flat_states is None:
+            self._init_flat_states()
+        for idx, group in enumerate(self.param_groups):
+            flat = self._flat_states.get(idx)
+            if flat is not None and self._can_use_flat(flat):
+                self._flat_step(group, flat)
+                continue
+            params, grads, exp_avgs, exp_avg_sqs, data_list = [], [], [], [], []
             for p in group["params"]:
                 if p.grad is None:
                     continue
-                bf16_param = p.data.dtype == torch.bfloat16
-                grad = p.grad.data
-                data = p.data
-                if grad.is_sparse:
+                if p.grad.is_sparse:
                     raise RuntimeError(
                         "Lamb does not support sparse gradients, consider SparseAdam instad."
                     )
+                state = self._init_state(p)
+                state["step"] += 1
 
-                state = self.state[p]
-                # State initialization
-                if len(state) == 0:
-                    state["step"] = 0
-                    # Exponential moving average of gradient values
-                    state["exp_avg"] = torch.zeros_like(p.data, dtype=torch.float32)
-                    # Exponential moving average of squared gradient values
-                    state["exp_avg_sq"] = torch.zeros_like(p.data, dtype=torch.float32)
-                    if bf16_param:
-                        # additional fp32 version of master weights
-                        state["data_fp32"] = p.data.to(torch.float32)
-
-                exp_avg, exp_avg_sq = state["exp_avg"], state["exp_avg_sq"]
-                beta1, beta2 = group["betas"]
-                if bf16_param:
-                    grad = grad.to(torch.float32)
-                    data = state["data_fp32"]
+                grad, exp_avg, exp_avg_sq, data = self._working_tensors(p, state)
+                params.append(p)
+                grads.append(grad)
+                exp_avgs.append(exp_avg)
+                exp_avg_sqs.append(exp_avg_sq)
+                data_list.append(data)
 
-                state["step"] += 1
+            if not params:
+                continue
+            if self._can_use_fused(params):
+                self._fused_step(group, params, grads, exp_avgs, exp_avg_sqs)
+                continue
+            beta1, beta2 = group["betas"]
+
+            # Decay the first and second moment running average coefficient
+            # m_t
+            torch._foreach_mul_(exp_avgs, beta1)
+            torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+            # v_t
+            torch._foreach_mul_(exp_avg_sqs, beta2)
+            torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
 
-                # Decay the first and second moment running average coefficient
-                # m_t
-                exp_avg.mul_(beta1).add_(grad, alpha=(1 - beta1))
-                # v_t
-                exp_avg_sq.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-
-                step_size = group["lr"]
-                if self.bias_correction:
-                    # Paper v3 does not use debiasing.
-                    exp_avg_hat = exp_avg / (1 - beta1 ** state["step"])
-                    exp_avg_sq_hat = exp_avg_sq / (1 - beta2 ** state["step"])
-                    # Apply bias to lr to avoid broadcast.
+            denoms = torch._foreach_sqrt(exp_avg_sqs)
+            if self.bias_correction:
+                # Paper v3 does not use debiasing.
+                # Apply bias to lr to avoid broadcast:
+                # m_hat / (sqrt(v_hat) + eps) == m / (sqrt(v) + eps * sqrt(bc2)) * sqrt(bc2) / bc1
+                steps = set(self.state[p]["step"] for p in params)
+                if len(steps) == 1:
+                    # the usual case, the whole group shares one step so the scalars are computed once
+                    bias_correction1, bias_correction2_sqrt = self._bias_corrections(beta1, beta2, steps.pop())
+                    torch._foreach_add_(denoms, group["eps"] * bias_correction2_sqrt)
+                    bias_scale = bias_correction2_sqrt / bias_correction1
                 else:
-                    exp_avg_hat = exp_avg
-                    exp_avg_sq_hat = exp_avg_sq
-
-                adam_step = exp_avg_hat / exp_avg_sq_hat.sqrt().add(group["eps"])
-                trust_ratio = 1
-                if group["weight_decay"] != 0:
-                    adam_step.add_(data, alpha=group["weight_decay"])
-
-                    weight_norm = data.pow(2).sum().sqrt()  # .clamp(0, 10)
-                    adam_norm = adam_step.pow(2).sum().sqrt()
-                    if weight_norm == 0 or adam_norm == 0:
-                        trust_ratio = 1
-                    else:
-                        trust_ratio = weight_norm / adam_norm
-                    if self.adam:
-                        trust_ratio = 1
-                    state["weight_norm"] = weight_norm
-                    state["adam_norm"] = adam_norm
-                    state["trust_ratio"] = trust_ratio
-
-                data.add_(adam_step, alpha=-step_size * trust_ratio)
-                if bf16_param:
-                    p.data = data.to(torch.bfloat16)
+                    corrections = [self._bias_corrections(beta1, beta2, self.state[p]["step"]) for p in params]
+                    torch._foreach_add_(denoms, [group["eps"] * bc2 for _, bc2 in corrections])
+                    bias_scale = [bc2 / bc1 for bc1, bc2 in corrections]
+            else:
+                torch._foreach_add_(denoms, group["eps"])
+                bias_scale = 1
+            adam_steps = torch._foreach_div(exp_avgs, denoms)
+
+            step_size = group["lr"]
+            if isinstance(bias_scale, float) and group["weight_decay"] == 0:
+                # a single scale for the group folds into the step size, saving a pass over the steps
+                step_size *= bias_scale
+            elif bias_scale != 1:
+                # the decay term and the trust ratio need the bias corrected step
+                torch._foreach_mul_(adam_steps, bias_scale)
+
+            if group["weight_decay"] != 0:
+                torch._foreach_add_(adam_steps, data_list, alpha=group["weight_decay"])
+
+                trust_ratios = self._trust_ratios(params, data_list, adam_steps)
+                if not self.adam:
+                    torch._foreach_mul_(adam_steps, list(trust_ratios.unbind()))
+
+            torch._foreach_add_(data_list, adam_steps, alpha=-step_size)
+            for p, exp_avg, exp_avg_sq, data in zip(params, exp_avgs, exp_avg_sqs, data_list):
+                self._store(p, self.state[p], exp_avg, exp_avg_sq, data)
 
         return loss
\ No newline at end of file
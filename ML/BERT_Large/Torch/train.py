@@ -99,12 +99,21 @@ def main(device, config):
     gc.log_seed(1)
     gc.start_init()
 
+    # with overlap the Lamb update runs inside backward, so the allreduce is done by Lamb instead of DDP
+    overlap = gc["opt"]["overlap"]
     model = get_bertlarge().to(gc.device)
-    if gc.world_size > 1:
-        model = nn.parallel.DistributedDataParallel(model)
+    if gc.world_size > 1 and not overlap:
+        # DDP already overlaps its bucketed allreduce with backward, writing the grads straight
+        # into the buckets saves a copy of every gradient per step
+        model = nn.parallel.DistributedDataParallel(model, gradient_as_bucket_view=True, static_graph=True)
         
     if gc["opt"]["name"].upper() == "LAMB":
-        opt = Lamb(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], weight_decay=gc["opt"]["wight_decay"])
+        states_dtype = torch.bfloat16 if gc["opt"]["bf16_optimizer_states"] else torch.float32
+        opt = Lamb(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], weight_decay=gc["opt"]["wight_decay"], perform_allreduce=overlap, overlap=overlap, states_dtype=states_dtype)
+        opt.register_overlap(model)
+        if overlap:
+            # without DDP nothing else broadcasts the initial weights from rank 0
+            opt.sync_params()
     else:
         raise NameError(f"Optimiser {gc['opt']['name']} not supported please use LAMB")
     
@@ -158,10 +167,13 @@ def main(device, config):
                 loss = model.forward(input_ids, token_type_ids, attention_mask, masked_lm_labels, next_sequence_labels)
                 loss.backward()
 
-                if hasattr(opt, "clip_grad_norm_"):
-                    ggnorm = opt.clip_grad_norm_(1.0)
-                else:
-                    ggnorm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+                # with overlap the params were already updated during backward and step only
+                # finishes the last buckets, so there are no grads left to clip
+                if not overlap:
+                    if hasattr(opt, "clip_grad_norm_"):
+                        ggnorm = opt.clip_grad_norm_(1.0)
+                    else:
+                        ggnorm = torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
 
                 opt.step()
                 lr_scheduler.step()
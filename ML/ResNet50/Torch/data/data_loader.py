@@ -1,6 +1,7 @@
 import os
 import random
 
+import torch
 from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, Subset
 from torch.utils.data.distributed import DistributedSampler
 from torchvision.datasets import ImageFolder
@@ -11,6 +12,42 @@ from ML.gc import GlobalContext
 gc = GlobalContext()
 
 
+class DevicePrefetcher:
+    """Wraps a loader and copies the next batch to the device on a side stream while the current batch is in use."""
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            x, y = next(it)
+        except StopIteration:
+            return None
+        if self.stream is None:
+            return x.to(self.device, memory_format=self.memory_format), y.to(self.device)
+        with torch.cuda.stream(self.stream):
+            return x.to(self.device, non_blocking=True, memory_format=self.memory_format), y.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self._preload(it)
+        while batch is not None:
+            if self.stream is not None:
+                torch.cuda.current_stream().wait_stream(self.stream)
+                for t in batch:
+                    # the memory was allocated on the copy stream, keep it alive for the compute stream
+                    t.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(it)
+            yield batch
+            batch = next_batch
+
+
 
 def get_train_dataloader():
 
@@ -59,7 +96,8 @@ def get_train_dataloader():
                       sampler=sampler,
                       batch_size=local_bs, 
                       drop_last=gc["data"]["drop_last_batch"],
-                      num_workers=1,
+                      num_workers=4,
+                      persistent_workers=True,
                       prefetch_factor=gc["data"]["prefetch"],
                       pin_memory = True if gc.device == "cuda" else False 
                       )
@@ -87,34 +87,44 @@ class Lars(Optimizer):
             lars = group['lars']
             eps = group['epsilon']
 
-            for index_p, p in enumerate(group['params']):
-                if p.grad is None:
-                    continue
-                decayed_grad = p.grad
-                scaled_lr = lr
-                if lars:
-                    w_norm = torch.norm(p)
-                    g_norm = torch.norm(p.grad)
-                    trust_ratio = torch.where(
-                        w_norm > 0 and g_norm > 0,
-                        eeta * w_norm / (g_norm + weight_decay * w_norm + eps),
-                        torch.ones_like(w_norm)
-                    )
-                    scaled_lr *= trust_ratio.item()
-                    if weight_decay != 0:
-                        decayed_grad = decayed_grad.add(p, alpha=weight_decay)
-
-                if momentum != 0:
+            params = [p for p in group['params'] if p.grad is not None]
+            if not params:
+                continue
+            grads = [p.grad for p in params]
+
+            # the whole group is updated with foreach kernels and the trust ratios stay
+            # on the device, a per parameter norm and .item() forces a sync for every tensor
+            scaled_lrs = None
+            if lars:
+                w_norms = torch.stack(torch._foreach_norm(params))
+                g_norms = torch.stack(torch._foreach_norm(grads))
+                trust_ratios = torch.where(
+                    (w_norms > 0) & (g_norms > 0),
+                    eeta * w_norms / (g_norms + weight_decay * w_norms + eps),
+                    torch.ones_like(w_norms)
+                )
+                scaled_lrs = list((trust_ratios * -lr).unbind())
+                if weight_decay != 0:
+                    grads = torch._foreach_add(grads, params, alpha=weight_decay)
+
+            if momentum != 0:
+                bufs = []
+                for p, decayed_grad in zip(params, grads):
                     param_state = self.state[p]
                     if 'momentum_buffer' not in param_state:
-                        buf = param_state['momentum_buffer'] = torch.clone(
-                            decayed_grad).detach()
+                        param_state['momentum_buffer'] = torch.clone(decayed_grad).detach()
                     else:
-                        buf = param_state['momentum_buffer']
-                        buf.mul_(momentum).add_(decayed_grad)
-                    decayed_grad = buf
-
-                p.add_(decayed_grad, alpha=-scaled_lr)
+                        bufs.append((param_state['momentum_buffer'], decayed_grad))
+                if bufs:
+                    old_bufs = [buf for buf, _ in bufs]
+                    torch._foreach_mul_(old_bufs, momentum)
+                    torch._foreach_add_(old_bufs, [g for _, g in bufs])
+                grads = [self.state[p]['momentum_buffer'] for p in params]
+
+            if scaled_lrs is not None:
+                torch._foreach_add_(params, torch._foreach_mul(grads, scaled_lrs))
+            else:
+                torch._foreach_add_(params, grads, alpha=-lr)
         return loss
 
 
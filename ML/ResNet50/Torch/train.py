@@ -15,6 +15,8 @@ path_root = "/".join(get_current_file().split("/")[:-4])
 sys.path.append(str(path_root))
 import click
 import time
+import contextlib
+import concurrent.futures
 
 import torch
 import torch.distributed as dist
@@ -28,26 +30,19 @@ import ML.ResNet50.Torch.data.data_loader as dl
 from ML.ResNet50.Torch.opt import Lars as LARS
 from ML.ResNet50.Torch.model.ResNet import ResNet50
 
-def train_step(x, y, model, loss_fn, opt, batch_idx):
-    if (batch_idx+1)% gc["data"]["gradient_accumulation_freq"] != 0:
-        if isinstance(model, torch.nn.parallel.DistributedDataParallel):
-            with model.no_sync():
-                logits = model(x)
-                loss = loss_fn(logits, y)/gc["data"]["gradient_accumulation_freq"]
-                #metric_tracker.update(logits, y)
-                loss.backward()
-        else:
+def train_step(x, y, model, loss_fn, opt, scaler, amp_type, batch_idx, accum, amp, use_no_sync):
+    do_step = (batch_idx+1) % accum == 0
+    # the grads are only allreduced on the backward that is followed by a step
+    with model.no_sync() if use_no_sync and not do_step else contextlib.nullcontext():
+        with torch.autocast(device_type=gc.device, dtype=amp_type, enabled=amp):
             logits = model(x)
-            loss = loss_fn(logits, y)/gc["data"]["gradient_accumulation_freq"]
-            #metric_tracker.update(logits, y)
-            loss.backward()
-    else:
-        logits = model(x)
-        loss = loss_fn(logits, y)/gc["data"]["gradient_accumulation_freq"]
+            loss = loss_fn(logits, y)/accum
         #metric_tracker.update(logits, y)
-        loss.backward()
-        opt.step()
-        opt.zero_grad()
+        scaler.scale(loss).backward()
+    if do_step:
+        scaler.step(opt)
+        scaler.update()
+        opt.zero_grad(set_to_none=True)
     return loss
 
 
@@ -58,6 +53,17 @@ def valid_step(x, y, model, loss_fn, metric_tracker):
         metric_tracker(logits, y)
         return loss
 
+def mean_or_nan(values):
+    # an epoch with no batches (a small subset with drop_last) has no samples to average
+    return sum(values)/len(values) if values else float("nan")
+
+def fused_kwargs(opt_cls):
+    # the fused kernels are cuda only and need a torch build whose optimizer accepts fused
+    if gc.device == "cuda" and "fused" in inspect.signature(opt_cls).parameters:
+        return {"fused": True}
+    return {}
+
+
 def get_comm_time(prof: torch.profiler.profile):
     total_time = 0
     if prof is None:
@@ -78,7 +84,8 @@ def get_comm_time(prof: torch.profiler.profile):
 @click.option("--local_batchsize", "-lbs", default=None, show_default=True, type=int, help="The Local Batchsize, Leave as 0 to use the Global Batchsize")
 @click.option("--t_subset_size", default=None, show_default=True, type=int, help="Size of the Training Subset, dont call to use full dataset")
 @click.option("--v_subset_size", default=None, show_default=True, type=int, help="Size of the Validation Subset, dont call to use full dataset")
-def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_size, v_subset_size):
+@click.option("--compile/--no-compile", "compile_model", default=None, help="Compile the model with torch.compile. If not provided will default to config.yaml")
+def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_size, v_subset_size, compile_model):
     if config:
         gc.update_config(config)
     if device.lower() in ('cpu', "gpu", "cuda"):
@@ -93,37 +100,67 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
         gc["data"]["train_subset"] = t_subset_size
     if v_subset_size is not None:
         gc["data"]["val_subset"] = v_subset_size
+    if compile_model is not None:
+        gc["training"]["compile"] = compile_model
     
     torch.manual_seed(1)
     gc.init_dist()
     if gc.device == "cuda":
         torch.cuda.set_device("cuda:" + str(gc.local_rank))
+        torch.backends.cudnn.benchmark = True
+        # tf32 keeps the fp32 range, any matmuls or convs left outside autocast use the tensor cores
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
     
     gc.start_init()
     gc.log_seed(1)
 
-    train_data = dl.get_train_dataloader()
-    val_data = dl.get_val_dataloader()
+    # scanning the image folders overlaps with building the model and creating the cuda context,
+    # the loaders are built in order on one thread as the train loader rewrites the batch config
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+        loaders = pool.submit(lambda: (dl.get_train_dataloader(), dl.get_val_dataloader()))
+        model = ResNet50(num_classes=1000).to(gc.device)
+        train_data, val_data = loaders.result()
     gc.log_resnet()
     if gc.rank == -1:  # change to -1 to turn off 0 to turn on
-        train_data = tqdm(train_data, unit="images", unit_scale=(gc["data"]["global_batch_size"] // gc.world_size)//gc["data"]["gradient_accumulation_freq"]) 
+        # refreshing on every batch costs more than a short step, redraw about 100 times an epoch
+        train_data = tqdm(train_data, mininterval=2.0, miniters=max(1, len(train_data)//100), unit="images", unit_scale=(gc["data"]["global_batch_size"] // gc.world_size)//gc["data"]["gradient_accumulation_freq"]) 
     
-    model = ResNet50(num_classes=1000).to(gc.device)
+    # NHWC lets cuDNN pick the tensor core conv kernels
+    memory_format = torch.channels_last if gc.device == "cuda" else torch.contiguous_format
+    model = model.to(memory_format=memory_format)
     if gc.world_size > 1:
-        model = torch.nn.parallel.DistributedDataParallel(model)
-        
-        if gc.device == "cpu":
-            pass
-        else:
+        # convert before wrapping, DDP expects the module it wraps to be final. SyncBN adds a
+        # collective to every BN layer, it is only worth it when the local batch is too small
+        local_bs = gc["data"]["global_batch_size"] // gc.world_size // gc["data"]["gradient_accumulation_freq"]
+        if gc.device != "cpu" and local_bs < gc["training"]["sync_bn_batch_threshold"]:
             model = torch.nn.SyncBatchNorm.convert_sync_batchnorm(model)
 
+        # 50MB buckets give ~3 allreduces per step for ResNet50's ~100MB of grads. static_graph only
+        # when there is no gradient accumulation, as it is incompatible with no_sync
+        model = torch.nn.parallel.DistributedDataParallel(
+            model,
+            device_ids=[gc.local_rank] if gc.device == "cuda" else None,
+            bucket_cap_mb=50,
+            find_unused_parameters=False,
+            gradient_as_bucket_view=True,
+            static_graph=gc["data"]["gradient_accumulation_freq"] == 1,
+        )
+
+    if gc["training"]["compile"]:
+        # modes that capture cuda graphs are avoided as they break with gradient accumulation
+        # the input shapes are fixed so the graph is specialised rather than traced with symbolic sizes,
+        # fullgraph is left off as DDP splits the graph at its bucket boundaries
+        model = torch.compile(model, mode=gc["training"].get("compile_mode", "default"), dynamic=False)
+
     if gc["opt"]["name"].upper() == "SGD":
         opt = torch.optim.SGD(
             model.parameters(),
             lr=gc["lr_schedule"]["base_lr"],
             momentum=gc["opt"]["momentum"],
             weight_decay=gc["opt"]["weight_decay"],
+            **fused_kwargs(torch.optim.SGD),
         )
     elif gc["opt"]["name"].upper() == "LARS":
         opt = LARS(
@@ -143,7 +180,15 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
 
     loss_fn = torch.nn.CrossEntropyLoss()
 
-    val_metric = Accuracy(task="multiclass", num_classes=1000)
+    if gc.device == "cuda":
+        amp_type = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    else:
+        amp_type = torch.bfloat16
+    # bf16 has the fp32 exponent range, loss scaling is only needed for fp16
+    scaler = torch.cuda.amp.grad_scaler.GradScaler(enabled=gc["training"]["amp"] and gc.device == "cuda" and amp_type == torch.float16)
+
+    # the metric state is gathered across the ranks by compute(), never per step
+    val_metric = Accuracy(task="multiclass", num_classes=1000, sync_on_compute=True, dist_sync_on_step=False)
 
     val_metric.to(gc.device)
 
@@ -151,9 +196,13 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
 
     model.eval()
     loss_fn.eval()
-    sample_x = torch.ones(1, 3, 244, 244, dtype=torch.float32).to(gc.device)
+    sample_x = torch.ones(1, 3, 244, 244, dtype=torch.float32).to(gc.device, memory_format=memory_format)
     sample_y = torch.randint(1, 1000, (1,), dtype=torch.int64).to(gc.device)
-    initial_loss = loss_fn.forward(model.forward(sample_x), sample_y)
+    # the probe runs on the uncompiled module, under no_grad with its own input shape it would
+    # fail the compiled graph's guards and trigger a second full compile
+    eager_model = getattr(model, "_orig_mod", model)
+    with torch.no_grad(), torch.autocast(device_type=gc.device, dtype=amp_type, enabled=gc["training"]["amp"] and gc.device == "cuda"):
+        initial_loss = loss_fn.forward(eager_model.forward(sample_x), sample_y).float()
     model.train()
     loss_fn.train()
     
@@ -161,34 +210,40 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
     
     model.train()
 
-    E = 1
-    
-    while True:
+    # config lookups are hoisted out of the hot loop
+    accum = gc["data"]["gradient_accumulation_freq"]
+    amp = gc["training"]["amp"] and gc.device == "cuda"
+    use_no_sync = hasattr(model, "no_sync")
+    # reused every epoch, filling it in place avoids a fresh allocation and blocking H2D copy
+    epoch_stats = torch.empty(3, dtype=torch.float64, device=gc.device)
+
+    val_accuracy = None
+    for E in range(1, gc["data"]["n_epochs"] + 1):
         start = time.time()
         gc.start_epoch(metadata={"epoch_num": E})
         total_io_time = 0
         power_draw = []
         gpu_utilization = []
-        with gc.profiler(f"Epoch: {E}") as prof:
+        # the communication time is only reported for the last epoch
+        with gc.profiler(f"Epoch: {E}", enabled=E == gc["data"]["n_epochs"]) as prof:
             start_io = time.time_ns()
-            for i, data in enumerate(train_data):
-                x, y = data
-                x, y = x.to(gc.device), y.to(gc.device)
+            for i, (x, y) in enumerate(dl.DevicePrefetcher(train_data, gc.device, memory_format)):
                 total_io_time += time.time_ns() - start_io
-                loss = train_step(x, y, model, loss_fn, opt, i)
+                loss = train_step(x, y, model, loss_fn, opt, scaler, amp_type, i, accum, amp, use_no_sync)
                 power_draw.append(gc.gpu_power)
                 gpu_utilization.append(gc.gpu_util)
-                torch.cuda.synchronize()
                 start_io = time.time_ns()
         total_io_time *= 1e-9
+        # sync once per epoch so the queued kernels are counted in the epoch time
+        if gc.device == "cuda":
+            torch.cuda.synchronize()
 
         total_time = time.time()-start
-        total_time = torch.tensor(total_time).to(gc.device)
-        avg_power_draw = torch.mean(torch.tensor(power_draw, dtype=torch.float64)).to(gc.device)
-        avg_gpu_util = torch.mean(torch.tensor(gpu_utilization, dtype=torch.float64)).to(gc.device)
-        dist.all_reduce(avg_gpu_util)
-        dist.all_reduce(avg_power_draw, op=dist.ReduceOp.SUM)
-        dist.all_reduce(total_time)
+        # reduce the epoch metrics in one collective
+        for i, value in enumerate((total_time, mean_or_nan(power_draw), mean_or_nan(gpu_utilization))):
+            epoch_stats[i].fill_(value)
+        dist.all_reduce(epoch_stats)
+        total_time, avg_power_draw, avg_gpu_util = epoch_stats
         total_time /= gc.world_size
         if gc.rank == 0:
             if E == 1:
@@ -204,33 +259,28 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
             if gc.device == "cuda":
                 print(f"Avg GPU Power Draw: {avg_power_draw*1e-3:.5f}")
                 print(f"Avg GPU Utilization: {avg_gpu_util/gc.world_size:.2f}")
-        dist.barrier()
         
         gc.start_eval(metadata={"epoch_num": E})
         if E % 4 == 0:
-            for x, y in val_data:
-                loss = valid_step(x.to(gc.device), y.to(gc.device), model, loss_fn, val_metric)
-            val_accuracy = val_metric.compute().to(gc.device)
-            dist.all_reduce(val_accuracy)
+            for x, y in dl.DevicePrefetcher(val_data, gc.device, memory_format):
+                loss = valid_step(x, y, model, loss_fn, val_metric)
+            val_accuracy = val_metric.compute()
+            val_metric.reset()
             if gc.rank == 0 and gc["training"]["benchmark"]:
-                print(f"Train Accuracy at Epoch {E}: {val_accuracy/gc.world_size}")
+                print(f"Train Accuracy at Epoch {E}: {val_accuracy}")
                 print(f"Validation Loss at Epoch {E}: {loss}")
         gc.stop_eval(metadata={"epoch_num": E})
+        # the epoch stats reduce already lines the ranks up for eval, one barrier
+        # afterwards keeps the next epoch's timer starting together on every rank
+        dist.barrier()
         gc.stop_epoch(metadata={"epoch_num": E})
-        if E >= gc["data"]["n_epochs"]:
-                break
-        if "val_accuracy" in dir(): 
-            if val_accuracy/gc.world_size >= gc["training"]["target_accuracy"]:
-                break
-        E += 1
+        if val_accuracy is not None and val_accuracy >= gc["training"]["target_accuracy"]:
+            break
         scheduler.step()
     
-    if "val_accuracy" in dir(): 
-        if val_accuracy/gc.world_size >= gc["training"]["target_accuracy"]:
-            gc.stop_run(metadata={"status": "success"})
-            gc.log_event(key="target_accuracy_reached", value=gc["training"]["target_accuracy"], metadata={"epoch_num": E-1})
-        else:
-            gc.stop_run(metadata={"status": "target not met"})
+    if val_accuracy is not None and val_accuracy >= gc["training"]["target_accuracy"]:
+        gc.stop_run(metadata={"status": "success"})
+        gc.log_event(key="target_accuracy_reached", value=gc["training"]["target_accuracy"], metadata={"epoch_num": E})
     else:
         gc.stop_run(metadata={"status": "target not met"})
 
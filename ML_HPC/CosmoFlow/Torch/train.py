@@ -113,7 +113,7 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
     gc.log_cosmoflow()
     
     if gc.rank == -1:
-        train_data = tqdm(train_data, miniters=64, unit="inputs", unit_scale=(gc["data"]["global_batch_size"] // gc.world_size)//gc["data"]["gradient_accumulation_freq"])
+        train_data = tqdm(train_data, mininterval=2.0, miniters=64, unit="inputs", unit_scale=(gc["data"]["global_batch_size"] // gc.world_size)//gc["data"]["gradient_accumulation_freq"])
 
     model = StandardCosmoFlow().to(gc.device)
     if gc.world_size > 1:
@@ -146,7 +146,8 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
         with gc.profiler(f"Epoch: {epoch+1}") as prof:
             start_io = time.time_ns()
             for idx, (x, y) in enumerate(train_data):
-                x, y = x.to(gc.device), y.to(gc.device)
+                # the loader pins its batches so the copy can overlap the previous step
+                x, y = x.to(gc.device, non_blocking=True), y.to(gc.device, non_blocking=True)
                 
                 total_io_time += time.time_ns() - start_io
                 power_draw.append(gc.gpu_power)
@@ -169,9 +170,11 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
                     opt.step()
                     opt.zero_grad()
                 
-                torch.cuda.synchronize()
                 start_io = time.time_ns()
                 
+        # a single sync per epoch, syncing every step stalls the host on each kernel launch
+        if gc.device == "cuda":
+            torch.cuda.synchronize()
         dist.barrier()
         total_io_time *= 1e-9
         
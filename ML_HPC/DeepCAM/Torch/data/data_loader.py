@@ -35,6 +35,42 @@ from ML_HPC.gc import GlobalContext
 gc = GlobalContext()
 
 
+class DevicePrefetcher:
+    """Wraps a loader and copies the next batch to the device on a side stream while the current batch is in use."""
+
+    def __init__(self, loader, device, memory_format=torch.contiguous_format):
+        self.loader = loader
+        self.device = device
+        self.memory_format = memory_format
+        self.stream = torch.cuda.Stream() if device == "cuda" else None
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, it):
+        try:
+            x, y = next(it)
+        except StopIteration:
+            return None
+        if self.stream is None:
+            return x.to(self.device, memory_format=self.memory_format), y.to(self.device)
+        with torch.cuda.stream(self.stream):
+            return x.to(self.device, non_blocking=True, memory_format=self.memory_format), y.to(self.device, non_blocking=True)
+
+    def __iter__(self):
+        it = iter(self.loader)
+        batch = self._preload(it)
+        while batch is not None:
+            if self.stream is not None:
+                torch.cuda.current_stream().wait_stream(self.stream)
+                for t in batch:
+                    # the memory was allocated on the copy stream, keep it alive for the compute stream
+                    t.record_stream(torch.cuda.current_stream())
+            next_batch = self._preload(it)
+            yield batch
+            batch = next_batch
+
+
 def peek_shapes_hdf5(data_dir):
     files = glob.iglob(os.path.join(data_dir, "*.h5"))
     with h5.File(next(files), "r") as fin:
@@ -201,6 +237,7 @@ def get_dataloaders():
     train_loader = DataLoader(train_set,
                               batch_size=local_bs,
                               num_workers =4,
+                              persistent_workers = True,
                               sampler = distributed_train_sampler,
                               pin_memory = True if gc.device != "cpu" else False,
                               drop_last = True,
@@ -13,6 +13,7 @@ path_root = "/".join(get_current_file().split("/")[:-4])
 sys.path.append(str(path_root))
 import time
 import warnings
+import contextlib
 warnings.filterwarnings("ignore")
 import click
 import json
@@ -53,6 +54,17 @@ class CELoss(nn.Module):
 
         return loss
 
+def mean_or_nan(values):
+    # an epoch with no batches (a small subset with drop_last) has no samples to average
+    return sum(values)/len(values) if values else float("nan")
+
+def fused_kwargs(opt_cls):
+    # the fused kernels are cuda only and need a torch build whose optimizer accepts fused
+    if gc.device == "cuda" and "fused" in inspect.signature(opt_cls).parameters:
+        return {"fused": True}
+    return {}
+
+
 def get_comm_time(prof: torch.profiler.profile):
     total_time = 0
     if prof is None:
@@ -72,7 +84,8 @@ def get_comm_time(prof: torch.profiler.profile):
 @click.option("--local_batchsize", "-lbs", default=None, show_default=True, type=int, help="The Local Batchsize, Leave as 0 to use the Global Batchsize")
 @click.option("--t_subset_size", default=None, show_default=True, type=int, help="Size of the Training Subset, dont call to use full dataset")
 @click.option("--v_subset_size", default=None, show_default=True, type=int, help="Size of the Validation Subset, dont call to use full dataset")
-def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_size, v_subset_size):
+@click.option("--compile/--no-compile", "compile_model", default=None, help="Compile the model with torch.compile. If not provided will default to config.yaml")
+def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_size, v_subset_size, compile_model):
     if config:
         gc.update_config(config)
     if device.lower() in ('cpu', "gpu", "cuda"):
@@ -87,6 +100,8 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
         gc["data"]["train_subset"] = t_subset_size
     if v_subset_size is not None:
         gc["data"]["val_subset"] = v_subset_size
+    if compile_model is not None:
+        gc["training"]["compile"] = compile_model
 
     
     torch.manual_seed(333)
@@ -106,14 +121,21 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
     model = DeepLabv3_plus(n_input=16, n_classes=3, pretrained=False, rank=gc.rank, process_group=None,).to(gc.device)
 
     if gc.world_size > 1:
-        model = torch.nn.parallel.DistributedDataParallel(model)
+        # writing the grads straight into the allreduce buckets saves a copy of every gradient per step.
+        # the graph is only static without gradient accumulation, static_graph breaks the no_sync micro-steps
+        model = torch.nn.parallel.DistributedDataParallel(model, gradient_as_bucket_view=True, static_graph=gc["data"]["gradient_accumulation_freq"] == 1)
+
+    if gc["training"]["compile"]:
+        # "reduce-overhead" is avoided as its cuda graphs break with gradient accumulation
+        model = torch.compile(model, mode="default")
 
     if gc["opt"]["name"].upper() == "ADAM":
-        opt = torch.optim.Adam(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], eps=1e-6, weight_decay=gc["opt"]["weight_decay"])
+        opt = torch.optim.Adam(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], eps=1e-6, weight_decay=gc["opt"]["weight_decay"], **fused_kwargs(torch.optim.Adam))
     elif gc["opt"]["name"].upper() == "ADAMW":
-        opt = torch.optim.AdamW(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], eps=1e-6, weight_decay=gc["opt"]["weight_decay"])
+        opt = torch.optim.AdamW(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], eps=1e-6, weight_decay=gc["opt"]["weight_decay"], **fused_kwargs(torch.optim.AdamW))
     elif gc["opt"]["name"].upper() == "LAMB":
-        opt = Lamb(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], eps=1e-6, weight_decay=gc["opt"]["weight_decay"])
+        states_dtype = torch.bfloat16 if gc["opt"]["bf16_optimizer_states"] else torch.float32
+        opt = Lamb(model.parameters(), lr=gc["lr_schedule"]["base_lr"], betas=gc["opt"]["betas"], eps=1e-6, weight_decay=gc["opt"]["weight_decay"], states_dtype=states_dtype)
     else:
         raise NameError(f"Optimiser {gc['opt']['name']} not supported please use ADAM|ADAMW|LAMB")
     
@@ -143,7 +165,10 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
     gc.stop_init()
     
     model.eval()
-    initial_loss = criterion.forward(model.forward(torch.ones(1, 16, 768, 1152).to(gc.device)), torch.ones(1, 1, 768, 1152, dtype=torch.long).to(gc.device))
+    # the probe runs on the uncompiled module, its batch size and grad mode would otherwise compile a graph training never uses
+    eager_model = getattr(model, "_orig_mod", model)
+    with torch.no_grad():
+        initial_loss = criterion.forward(eager_model.forward(torch.ones(1, 16, 768, 1152).to(gc.device)), torch.ones(1, 1, 768, 1152, dtype=torch.long).to(gc.device))
     model.train()
     if gc.rank == 0:
         print(json.dumps(dict(gc), indent=2))
@@ -158,6 +183,13 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
         amp_type = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
     else:
         amp_type = torch.bfloat16
+    # config lookups are hoisted out of the hot loop
+    accum = gc["data"]["gradient_accumulation_freq"]
+    amp = gc["training"]["amp"] and gc.device == "cuda"
+    n_batches = len(train_data)
+    use_no_sync = hasattr(model, "no_sync")
+    # reused every epoch, filling it in place avoids a fresh allocation and blocking H2D copy
+    hw_stats = torch.empty(2, dtype=torch.float64, device=gc.device)
     # Train Loop
     while True:
         
@@ -168,49 +200,46 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
         total_io_time = 0
         power_draw = []
         gpu_utilization = []
+        # running sum of the train loss, kept on device so the loop never syncs for metrics
+        loss_sum = torch.zeros((), device=gc.device)
 
         with gc.profiler(f"Epoch: {epoch+1}") as prof:
             start_io = time.time_ns()
-            for idx, (x, y) in enumerate(train_data):
-                x, y = x.to(gc.device), y.to(gc.device)
-
+            for idx, (x, y) in enumerate(dl.DevicePrefetcher(train_data, gc.device)):
                 total_io_time += time.time_ns() - start_io    
                 power_draw.append(gc.gpu_power)
                 gpu_utilization.append(gc.gpu_util)
-                if ((idx + 1)%gc["data"]["gradient_accumulation_freq"]!=0) or (idx+1 != len(train_data)):
-                    if isinstance(model, nn.parallel.DistributedDataParallel):
-                        with model.no_sync():
-                            with torch.autocast(device_type=gc.device, dtype=amp_type, enabled=gc["training"]["amp"] and gc.device == "cuda"):
-                                logits = model.forward(x)
-                                loss = criterion.forward(logits, y)/gc["data"]["gradient_accumulation_freq"]
-                            scaler.scale(loss).backward()
-                        
-                    else:
-                        with torch.autocast(device_type=gc.device, dtype=amp_type, enabled=gc["training"]["amp"] and gc.device == "cuda"):
-                            logits = model.forward(x)
-                            loss = criterion.forward(logits, y)/gc["data"]["gradient_accumulation_freq"]
-                        scaler.scale(loss).backward()
-                else: 
-                    with torch.autocast(device_type=gc.device, dtype=amp_type, enabled=gc["training"]["amp"] and gc.device == "cuda"):
-                        logits = model.forward(x)
-                        loss = criterion.forward(logits, y)/gc["data"]["gradient_accumulation_freq"]
+                # step every accum batches and on the last batch of the epoch
+                do_step = (idx + 1) % accum == 0 or idx + 1 == n_batches
+                with model.no_sync() if use_no_sync and not do_step else contextlib.nullcontext():
+                    with torch.autocast(device_type=gc.device, dtype=amp_type, enabled=amp):
+                        logits = model(x)
+                        loss = criterion.forward(logits, y)/accum
                     scaler.scale(loss).backward()
+                if do_step:
                     scaler.step(opt)
                     scaler.update()
                     opt.zero_grad(set_to_none=True)
                     scheduler.step()
+                loss_sum += loss.detach().float()
                 start_io = time.time_ns()
                     
                 if idx % 16 == 0:
                     if gc.rank == 0:
-                        print(f"Epoch: {epoch+1} Batch: {idx}/{len(train_data)} Train Time: {time.time()-start} IO Time: {total_io_time*1e-9}")
+                        print(f"Epoch: {epoch+1} Batch: {idx}/{n_batches} Train Time: {time.time()-start} IO Time: {total_io_time*1e-9}")
         
         total_io_time *= 1e-9
         total_time = time.time()-start
-        avg_power_draw = torch.mean(torch.tensor(power_draw, dtype=torch.float64)).to(gc.device)
-        avg_gpu_util = torch.mean(torch.tensor(gpu_utilization, dtype=torch.float64)).to(gc.device)
-        dist.all_reduce(avg_power_draw)
-        dist.all_reduce(avg_gpu_util)
+        # softmax is monotonic, argmax of the logits gives the same classes
+        predictions = torch.argmax(logits, 1)
+        iou = compute_score(predictions, y, num_classes=3)
+        # loss and iou go to rank 0 in one reduce, launched early so it overlaps the power/util allreduce
+        metrics = torch.stack([loss_sum / n_batches, iou.detach().float()])
+        metrics_work = dist.reduce(metrics, dst=0, op=dist.ReduceOp.SUM, async_op=True) if dist.is_initialized() else None
+        hw_stats[0].fill_(mean_or_nan(power_draw))
+        hw_stats[1].fill_(mean_or_nan(gpu_utilization))
+        dist.all_reduce(hw_stats)
+        avg_power_draw, avg_gpu_util = hw_stats
         if gc.rank == 0:
             if epoch == 0:
                 print(f"Change In Train Loss at Epoch: {initial_loss - loss}")
@@ -224,17 +253,9 @@ def main(device, config, data_dir, global_batchsize, local_batchsize, t_subset_s
             print(f"Total IO Time: {total_io_time}")
 
 
-        loss_avg = loss.detach()
-        if dist.is_initialized():
-            dist.reduce(loss_avg, dst=0, op=dist.ReduceOp.SUM)
-        loss_avg_train = loss_avg.item() / float(gc.world_size)
-
-        predictions = torch.argmax(torch.softmax(logits, 1), 1)
-        iou = compute_score(predictions, y, num_classes=3)
-        iou_avg = iou.detach()
-        if dist.is_initialized():
-            dist.reduce(iou_avg, dst=0, op=dist.ReduceOp.SUM)
-        iou_avg_train = iou_avg.item() / float(gc.world_size)
+        if metrics_work is not None:
+            metrics_work.wait()
+        loss_avg_train, iou_avg_train = (metrics / float(gc.world_size)).tolist()
 
         gc.log_event(key="learning_rate", value=scheduler.get_last_lr()[0], metadata={"epoch_num": epoch+1})
         gc.log_event(key="training_accuracy", value=iou_avg_train, metadata={"epoch_num": epoch+1})
@@ -75,7 +75,7 @@ def validate(net, criterion, validation_loader, epoch):
             count_sum_val += 1.
         
             # Compute score
-            predictions_val = torch.argmax(torch.softmax(outputs_val, 1), 1)
+            predictions_val = torch.argmax(outputs_val, 1)
             iou_val = compute_score(predictions_val, label_val, num_classes=3)
             iou_sum_val += iou_val
         
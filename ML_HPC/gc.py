@@ -1,5 +1,11 @@
 import yaml
 import os
+import copy
+import time
+import queue
+import atexit
+import functools
+import threading
 from packaging import version
 from contextlib import contextmanager
 
@@ -9,6 +15,29 @@ from torch.profiler import profile, record_function, ProfilerActivity
 from mlperf_logging import mllog
 from mlperf_logging.mllog import constants as log_constants
 
+# the C loader is much faster than the pure python one, it is only missing when pyyaml is built without libyaml
+_YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+_CONFIG_CACHE = {}
+
+def _load_config(config_path):
+    # keyed on the modification time so an edited config is picked up again
+    key = (os.path.abspath(config_path), os.stat(config_path).st_mtime_ns)
+    if key not in _CONFIG_CACHE:
+        with open(config_path, "r") as stream:
+            _CONFIG_CACHE[key] = yaml.load(stream, Loader=_YAML_LOADER)
+    # the context is mutated by the cli overrides, keep the cached copy pristine
+    return copy.deepcopy(_CONFIG_CACHE[key])
+
+# the power and utilisation probes are read every iteration, parse the torch version once
+_TORCH_VERSION = version.parse(torch.__version__).release
+
+# (epsilon, beta 1, beta 2) mllog keys for each deepcam optimiser
+_DEEPCAM_OPT_KEYS = {
+    "ADAM": (log_constants.OPT_ADAM_EPSILON, log_constants.OPT_ADAM_BETA_1, log_constants.OPT_ADAM_BETA_2),
+    "ADAMW": (log_constants.OPT_ADAMW_EPSILON, log_constants.OPT_ADAMW_BETA_1, log_constants.OPT_ADAMW_BETA_2),
+    "LAMB": (log_constants.OPT_LAMB_EPSILON, log_constants.OPT_LAMB_BETA_1, log_constants.OPT_LAMB_BETA_2),
+}
+
 class SingletonMetaClass(type):
     _instances = {}
 
@@ -17,15 +46,22 @@ class SingletonMetaClass(type):
             cls._instances[cls] = super(SingletonMetaClass, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
-def _run_on_0(func):
-    def wrapper(*args, **kwrags):
-        if "sync" in kwrags.keys():
-            if kwrags["sync"]:
-                dist.barrier()
-        if dist.get_rank() == 0:
-            return func(*args, **kwrags)
+def _run_on_0(func, allow_sync=False):
+    @functools.wraps(func)
+    def wrapper(self, *args, sync=False, **kwargs):
+        # only the init/run boundaries may synchronise the ranks, a barrier on every
+        # epoch or log call would stall all of them on rank 0's logging
+        if sync and allow_sync:
+            dist.barrier()
+        # the rank is cached in the context after the first lookup
+        if self.rank != 0:
+            return None
+        return func(self, *args, **kwargs)
     return wrapper
 
+def _run_on_0_synced(func):
+    return _run_on_0(func, allow_sync=True)
+
 class GlobalContext(dict, metaclass=SingletonMetaClass):
     _config_path = None
     """
@@ -35,12 +71,12 @@ class GlobalContext(dict, metaclass=SingletonMetaClass):
     """
     def __init__(self, config_path=None):
         self.mllogger = mllog.get_mllogger()
+        self._log_queue = None
+        self._log_error = None
+        self._log_buffer = []
+        atexit.register(self._flush_log)
         if not self.__dict__ and config_path is not None:
-            with open(config_path, "r") as stream:
-                self.clear()
-                self.update(yaml.safe_load(stream))
-                if self["device"].lower() == 'gpu':
-                    self["device"] = "cuda"
+            self.update_config(config_path)
 
     def init_dist(self):
         if dist.is_mpi_available() and not dist.is_torchelastic_launched():
@@ -69,9 +105,8 @@ class GlobalContext(dict, metaclass=SingletonMetaClass):
             if dist.is_torchelastic_launched():
                 self["local_rank"] = int(os.environ['LOCAL_RANK'])
             else:
-                # slurm
-                taskspernode = int(os.environ["SLURM_NTASKS"]) // int(os.environ["SLURM_NNODES"])
-                self["local_rank"] = int(os.environ["SLURM_PROCID"])%taskspernode
+                # slurm, the tasks per node are parsed once by local_world_size
+                self["local_rank"] = int(os.environ["SLURM_PROCID"])%self.local_world_size
         return self["local_rank"]
     
     @property
@@ -90,30 +125,31 @@ class GlobalContext(dict, metaclass=SingletonMetaClass):
         return self["device"].lower()
     
     def update_config(self, config_path):
-        with open(config_path, "r") as stream:
-            self.clear()
-            self.update(yaml.safe_load(stream))
-            if self["device"].lower() == 'gpu':
-                self["device"] = "cuda"
+        config = _load_config(config_path)
+        self.clear()
+        self.update(config)
+        if self["device"].lower() == 'gpu':
+            self["device"] = "cuda"
     
     @property
     def gpu_power(self):
-        t_ver = version.parse(torch.__version__).release
-        if t_ver[0] == 2 and t_ver[1] >= 1 and torch.cuda.is_available() and torch.version.cuda:
+        if _TORCH_VERSION[0] == 2 and _TORCH_VERSION[1] >= 1 and torch.cuda.is_available() and torch.version.cuda:
             return torch.cuda.power_draw()
         else:
             return 0.0
     
     @property
     def gpu_util(self):
-        t_ver = version.parse(torch.__version__).release
-        if t_ver[0] == 2 and torch.cuda.is_available() and torch.version.cuda:
+        if _TORCH_VERSION[0] == 2 and torch.cuda.is_available() and torch.version.cuda:
             return torch.cuda.utilization()
         else:
             return 0.0
     
     @_run_on_0
     def log_cosmoflow(self):
+        # these events are written synchronously, anything still buffered by _log_async goes out
+        # first so the mllog order matches the call order
+        self._flush_log()
         self.mllogger.default_namespace = "cosmoflow"
         self.mllogger.event(key=log_constants.OPT_NAME, value="SGD")
         self.mllogger.event(key=log_constants.LARS_OPT_MOMENTUM, value=self["opt"]["momentum"])
@@ -121,34 +157,31 @@ class GlobalContext(dict, metaclass=SingletonMetaClass):
         self.mllogger.event(key="dropout", value=0.5)
         self.mllogger.event(key=log_constants.OPT_BASE_LR, value=self["lr_schedule"]["base_lr"])
         self.mllogger.event(key=log_constants.OPT_LR_WARMUP_EPOCHS, value=self["lr_schedule"]["n_warmup_epochs"])
-        self.mllogger.event(key=log_constants.OPT_LR_DECAY_FACTOR, value=max(self["lr_schedule"]["decay_schedule"].values()) if len(self["lr_schedule"]["decay_schedule"])>0 else 1)
+        decay_schedule = self["lr_schedule"]["decay_schedule"]
+        self.mllogger.event(key=log_constants.OPT_LR_DECAY_FACTOR, value=max(decay_schedule.values()) if decay_schedule else 1)
         self.log_cluster_info()
     
     @_run_on_0
     def log_deepcam(self):
+        self._flush_log()
         self.mllogger.default_namespace = "deepcam"
-        self.mllogger.event(key=log_constants.OPT_NAME, value=self["opt"]["name"].upper())
-        if self["opt"]["name"].upper() == "ADAM":
-            self.mllogger.event(key=log_constants.OPT_ADAM_EPSILON, value=1.0e-6)
-            self.mllogger.event(key=log_constants.OPT_ADAM_BETA_1, value=self["opt"]["betas"][0])
-            self.mllogger.event(key=log_constants.OPT_ADAM_BETA_2, value=self["opt"]["betas"][1])
-        elif self["opt"]["name"].upper() == "ADAMW":
-            self.mllogger.event(key=log_constants.OPT_ADAMW_EPSILON, value=1.0e-6)
-            self.mllogger.event(key=log_constants.OPT_ADAMW_BETA_1, value=self["opt"]["betas"][0])
-            self.mllogger.event(key=log_constants.OPT_ADAMW_BETA_2, value=self["opt"]["betas"][1])
-        elif self["opt"]["name"].upper() == "LAMB":
-            self.mllogger.event(key=log_constants.OPT_LAMB_EPSILON, value=1.0e-6)
-            self.mllogger.event(key=log_constants.OPT_LAMB_BETA_1, value=self["opt"]["betas"][0])
-            self.mllogger.event(key=log_constants.OPT_LAMB_BETA_2, value=self["opt"]["betas"][1])
+        opt_name = self["opt"]["name"].upper()
+        self.mllogger.event(key=log_constants.OPT_NAME, value=opt_name)
+        if opt_name in _DEEPCAM_OPT_KEYS:
+            eps_key, beta_1_key, beta_2_key = _DEEPCAM_OPT_KEYS[opt_name]
+            self.mllogger.event(key=eps_key, value=1.0e-6)
+            self.mllogger.event(key=beta_1_key, value=self["opt"]["betas"][0])
+            self.mllogger.event(key=beta_2_key, value=self["opt"]["betas"][1])
         
         self.mllogger.event(key=log_constants.OPT_BASE_LR, value=self["lr_schedule"]["base_lr"])
         self.mllogger.event(key=log_constants.OPT_LR_WARMUP_STEPS, value=self["lr_schedule"]["lr_warmup_steps"])
         self.mllogger.event(key=log_constants.OPT_LR_WARMUP_FACTOR, value=self["lr_schedule"]["lr_warmup_factor"])
         self.mllogger.event(key="scheduler_type", value=self["lr_schedule"]["type"])
-        if self["lr_schedule"]["type"].upper() == "MULTISTEP":
+        scheduler_type = self["lr_schedule"]["type"].upper()
+        if scheduler_type == "MULTISTEP":
             self.mllogger.event(key="scheduler_milestones", value=self["lr_schedule"]["milestones"])
             self.mllogger.event(key=log_constants.OPT_LR_DECAY_FACTOR, value=self["lr_schedule"]["decay_rate"])
-        if self["lr_schedule"]["type"].upper() == "COSINE_ANNEALING":
+        elif scheduler_type == "COSINE_ANNEALING":
             self.mllogger.event(key="scheduler_t_max", value=self["lr_schedule"]["t_max"])
             self.mllogger.event(key="scheduler_eta_min", value=self["lr_schedule"]["eta_min"])
         
@@ -157,74 +190,126 @@ class GlobalContext(dict, metaclass=SingletonMetaClass):
     
     @_run_on_0
     def log_cluster_info(self):
+        self._flush_log()
         if dist.is_torchelastic_launched():
             accels_per_node = int(os.environ["LOCAL_WORLD_SIZE"])
-            num_nodes = dist.get_world_size()//accels_per_node
+            num_nodes = self.world_size//accels_per_node
             accels_per_node = accels_per_node if torch.cuda.is_available() else 0
         else:
             num_nodes = int(os.environ["SLURM_NNODES"])
-            accels_per_node = dist.get_world_size()//int(os.environ["SLURM_NNODES"]) if torch.cuda.is_available() else 0
-        self.mllogger.event(key="number_of_ranks", value=dist.get_world_size())
+            accels_per_node = self.world_size//num_nodes if torch.cuda.is_available() else 0
+        self.mllogger.event(key="number_of_ranks", value=self.world_size)
         self.mllogger.event(key="number_of_nodes", value=num_nodes)
         #accels_per_node = dist.get_world_size()//int(os.environ["SLURM_NNODES"]) if torch.cuda.is_available() else 0
         self.mllogger.event(key="accelerators_per_node", value=accels_per_node)
 
-    @_run_on_0
     def print_0(self, *args, **kwargs):
-        print(*args, **kwargs)
+        # called from the training loops, the rank check is inlined rather than going through _run_on_0
+        if self.rank == 0:
+            print(*args, **kwargs)
     
     @contextmanager
-    def profiler(self, name: str):
-        if self.rank != -1:
+    def profiler(self, name: str, enabled: bool = True, flops: bool = False, memory: bool = False, stack: bool = False):
+        """
+        profiles the enclosed code on rank 0 when training.profile is set in the config, otherwise yields None
+
+        the whole block is recorded so the per epoch totals stay meaningful. flop counting, memory and
+        stack recording are expensive and off by default
+        """
+        if not enabled or not self["training"].get("profile", False) or self.rank != 0:
             yield None
         else:
             if self.device == "cpu":
                 activities=[ProfilerActivity.CPU]
             else:
                 activities=[ProfilerActivity.CPU, ProfilerActivity.CUDA]
-            with profile(activities=activities, with_flops=True) as prof:
+            with profile(activities=activities, with_flops=flops, profile_memory=memory, with_stack=stack) as prof:
                 with record_function(name):
                     yield prof
         
-    @_run_on_0
-    def log_event(self, *args, sync=True, **kwargs):
-        self.mllogger.event(*args, **kwargs)
+    def _log_async(self, log_fn, *args, **kwargs):
+        # the event is written by a background thread, the timestamp is taken now so the queue does not skew it
+        kwargs.setdefault("time_ms", int(time.time() * 1e3))
+        self._log_buffer.append((log_fn, args, kwargs))
+
+    def _submit_log(self):
+        # events are handed over once per epoch so the writer thread is not woken,
+        # and competing for the GIL, on every event during training
+        if not self._log_buffer:
+            return
+        if self._log_queue is None:
+            self._log_queue = queue.Queue()
+            threading.Thread(target=self._drain_log_queue, daemon=True).start()
+        self._log_queue.put(self._log_buffer)
+        self._log_buffer = []
+
+    def _drain_log_queue(self):
+        while True:
+            events = self._log_queue.get()
+            try:
+                for log_fn, args, kwargs in events:
+                    # a failing event must not kill the writer, the next flush would then wait forever.
+                    # the first error is kept and raised by _flush_log on the caller's thread
+                    try:
+                        log_fn(*args, **kwargs)
+                    except Exception as e:
+                        if self._log_error is None:
+                            self._log_error = e
+            finally:
+                self._log_queue.task_done()
+
+    def _flush_log(self):
+        self._submit_log()
+        if self._log_queue is not None:
+            self._log_queue.join()
+        if self._log_error is not None:
+            error, self._log_error = self._log_error, None
+            raise error
+
+    def log_event(self, *args, **kwargs):
+        if self.rank == 0:
+            self._log_async(self.mllogger.event, *args, **kwargs)
     
     @_run_on_0
-    def log_seed(self, seed, sync=True):
-        self.mllogger.event(key=log_constants.SEED, value=seed)
+    def log_seed(self, seed):
+        self._log_async(self.mllogger.event, key=log_constants.SEED, value=seed)
 
-    @_run_on_0
-    def start_init(self, sync=True):
+    @_run_on_0_synced
+    def start_init(self):
+        self._flush_log()
         self.mllogger.start(key=log_constants.INIT_START, value=None)
     
-    @_run_on_0
-    def stop_init(self, sync=True):
+    @_run_on_0_synced
+    def stop_init(self):
+        self._flush_log()
         self.mllogger.end(key=log_constants.INIT_STOP, value=None)
     
-    @_run_on_0
-    def start_run(self, sync=True):
+    @_run_on_0_synced
+    def start_run(self):
         print("\n")
+        self._flush_log()
         self.mllogger.start(key=log_constants.RUN_START, value=None)
     
-    @_run_on_0
-    def stop_run(self, metadata = {"status": "success"}, sync=True):
+    @_run_on_0_synced
+    def stop_run(self, metadata = {"status": "success"}):
+        self._flush_log()
         self.mllogger.end(key=log_constants.RUN_STOP, value=None, metadata=metadata)
     
     @_run_on_0
-    def start_epoch(self, metadata, sync=True):
-        self.mllogger.start(key=log_constants.EPOCH_START, value=None, metadata=metadata)
+    def start_epoch(self, metadata):
+        self._log_async(self.mllogger.start, key=log_constants.EPOCH_START, value=None, metadata=metadata)
 
     @_run_on_0
-    def stop_epoch(self, metadata, sync=True):
-        self.mllogger.end(key=log_constants.EPOCH_STOP, value=None, metadata=metadata)
+    def stop_epoch(self, metadata):
+        self._log_async(self.mllogger.end, key=log_constants.EPOCH_STOP, value=None, metadata=metadata)
+        self._submit_log()
     
     @_run_on_0
-    def start_eval(self, metadata, sync=True):
-        self.mllogger.start(key=log_constants.EVAL_START, value=None, metadata=metadata)
+    def start_eval(self, metadata):
+        self._log_async(self.mllogger.start, key=log_constants.EVAL_START, value=None, metadata=metadata)
     
     @_run_on_0
-    def stop_eval(self, metadata, sync=True):
-        self.mllogger.end(key=log_constants.EVAL_STOP, value=None, metadata=metadata)
+    def stop_eval(self, metadata):
+        self._log_async(self.mllogger.end, key=log_constants.EVAL_STOP, value=None, metadata=metadata)
 
 
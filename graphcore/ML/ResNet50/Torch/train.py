@@ -3,7 +3,6 @@ from pathlib import Path
 import sys
 path_root = Path(os.getcwd()).parents[2]
 sys.path.append(str(path_root))
-import csv
 import click
 import time
 
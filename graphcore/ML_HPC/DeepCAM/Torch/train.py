@@ -116,7 +116,7 @@ def main(device, config):
         loss_avg = loss.detach()
         loss_avg_train = loss_avg.item() / float(gc.world_size)
 
-        predictions = torch.argmax(torch.softmax(logits, 1), 1)
+        predictions = torch.argmax(logits, 1)
         iou = compute_score(predictions, y, num_classes=3)
         iou_avg = iou.detach()
         iou_avg_train = iou_avg.item() / float(gc.world_size)